@@ -9,6 +9,7 @@ import time
 from record_audio import AudioRecorder
 from speech_to_text import SpeechToText
 import os
+import logging
 import tempfile
 from dotenv import load_dotenv
 
@@ -87,6 +88,7 @@ class JoinGoogleMeet:
         AudioRecorder().get_audio(audio_path, duration)
 
 def main():
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'), format='%(levelname)s %(message)s')
     temp_dir = tempfile.mkdtemp()
     audio_path = os.path.join(temp_dir, "output.wav")
     # Get configuration from environment variables
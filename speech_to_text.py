@@ -1,157 +1,630 @@
-import requests
+import asyncio
+import contextlib
+import aiohttp
+import aiofiles
 import json
+import logging
+import collections
+import hashlib
 import os
+import re
+import stat
 import subprocess
 import tempfile
 import datetime
+import functools
+import time
+import numpy
+import orjson
 from dotenv import load_dotenv
-from google import genai
-from google.generativeai import types
+from mutagen import File as MutagenFile, MutagenError
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+import google.generativeai as genai
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Hesitações comuns na fala; "um" e "tipo" ficam de fora porque também são palavras comuns em português
+FILLER_WORDS_RE = re.compile(r",?\s*\b(?:uh+|hum+|hm+|ahn+|eh+|né)\b,?", re.IGNORECASE)
+SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?])\s+")
+
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+# 500/502/504 podem chegar depois de o Scribe já ter processado (e cobrado) o áudio, então não repetem o envio
+RETRYABLE_UPLOAD_STATUS_CODES = (429, 503)
+
+
+def _is_retryable_error(exception):
+    # Limite de requisições (429), erros 5xx e falhas de conexão são transitórios; o resto é repassado na hora
+    if isinstance(exception, aiohttp.ClientResponseError):
+        return exception.status in RETRYABLE_STATUS_CODES
+    return isinstance(exception, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+
+def _is_retryable_upload_error(exception):
+    # O envio à ElevenLabs é cobrado: só repete quando o áudio foi recusado antes de ser processado
+    # (429, 503 ou falha ao abrir a conexão), nunca em timeout de leitura no meio do envio/processamento
+    if isinstance(exception, aiohttp.ClientResponseError):
+        return exception.status in RETRYABLE_UPLOAD_STATUS_CODES
+    return isinstance(exception, (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError))
+
+
+def _ensure_private_dir(path):
+    # Os diretórios padrão ficam no temp compartilhado: cria só para o usuário atual (0700) e recusa
+    # um diretório (ou link simbólico) criado antes por outro usuário
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    path_stat = os.lstat(path)
+    if stat.S_ISLNK(path_stat.st_mode) or not stat.S_ISDIR(path_stat.st_mode):
+        raise PermissionError(f"{path} não é um diretório comum.")
+    if hasattr(os, "getuid") and path_stat.st_uid != os.getuid():
+        raise PermissionError(f"{path} pertence a outro usuário.")
+    if stat.S_IMODE(path_stat.st_mode) & 0o077:
+        os.chmod(path, 0o700)
+
+
+def _private_file_opener(path, flags):
+    # Usado como opener= no open(): arquivos com transcrições e atas só podem ser lidos pelo dono
+    return os.open(path, flags, 0o600)
+
+
+api_retry = retry(
+    wait=wait_exponential(multiplier=0.5, max=8),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception(_is_retryable_error),
+    reraise=True
+)
+
+upload_retry = retry(
+    wait=wait_exponential(multiplier=0.5, max=8),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception(_is_retryable_upload_error),
+    reraise=True
+)
+
 class SpeechToText:
-    def __init__(self):
-        self.elevenlabs_api_key = os.getenv("ELEVENLABS_API_KEY")
-        self.gemini_api_key = os.getenv("GEMINI_API_KEY")
-        
-        if not self.elevenlabs_api_key:
-            raise ValueError("ELEVENLABS_API_KEY não configurada nas variáveis de ambiente.")
-        if not self.gemini_api_key:
-            raise ValueError("GEMINI_API_KEY não configurada nas variáveis de ambiente.")
+    ABSTRACT_SUMMARY_PROMPT = "Você é uma IA altamente qualificada, treinada em compreensão de linguagem e sumarização. Gostaria que você lesse o texto a seguir e o resumisse em um parágrafo abstrato conciso. Procure reter os pontos mais importantes, fornecendo um resumo coerente e legível que possa ajudar uma pessoa a entender os pontos principais da discussão sem precisar ler o texto inteiro. Evite detalhes desnecessários ou pontos tangenciais."
+    KEY_POINTS_PROMPT = "Você é uma IA proficiente com especialidade em destilar informações em pontos-chave. Com base no texto a seguir, identifique e liste os principais pontos que foram discutidos ou levantados. Devem ser as ideias, descobertas ou tópicos mais importantes que são cruciais para a essência da discussão. Seu objetivo é fornecer uma lista que alguém possa ler para entender rapidamente sobre o que foi falado."
+    ACTION_ITEMS_PROMPT = "Você é um especialista em IA em analisar conversas e extrair itens de ação. Revise o texto e identifique quaisquer tarefas, atribuições ou ações que foram acordadas ou mencionadas como necessitando ser feitas. Podem ser tarefas atribuídas a indivíduos específicos ou ações gerais que o grupo decidiu tomar. Liste esses itens de ação de forma clara e concisa."
+    SENTIMENT_PROMPT = "Como uma IA com experiência em análise de linguagem e emoção, sua tarefa é analisar o sentimento do texto a seguir. Considere o tom geral da discussão, a emoção transmitida pela linguagem utilizada e o contexto em que palavras e frases são usadas. Indique se o sentimento é geralmente positivo, negativo ou neutro e forneça breves explicações para sua análise, quando possível."
 
-        genai.configure(api_key=self.gemini_api_key)
-        
+    ELEVENLABS_STT_URL = "https://api.elevenlabs.io/v1/speech-to-text"
+    GEMINI_STREAM_URL = "https://generativelanguage.googleapis.com/v1beta/models/{model}:streamGenerateContent"
+    GEMINI_CONTEXT_CACHE_TTL = datetime.timedelta(hours=1)
+
+    CHUNK_SUMMARY_PROMPT = "Você é uma IA especializada em condensar transcrições de reuniões. Reescreva o trecho a seguir de forma resumida, preservando todos os fatos, decisões, tarefas, responsáveis, prazos e o tom da conversa. Não adicione informações que não estejam no texto."
+
+    MEETING_MINUTES_KEYS = ('abstract_summary', 'key_points', 'action_items', 'sentiment')
+    MEETING_MINUTES_PROMPT = (
+        "Você vai analisar a transcrição de uma reunião e responder apenas com um objeto JSON "
+        "com exatamente as chaves \"abstract_summary\", \"key_points\", \"action_items\" e \"sentiment\". "
+        "O valor de cada chave deve ser uma string, seguindo as instruções abaixo.\n\n"
+        f"abstract_summary: {ABSTRACT_SUMMARY_PROMPT}\n\n"
+        f"key_points: {KEY_POINTS_PROMPT}\n\n"
+        f"action_items: {ACTION_ITEMS_PROMPT}\n\n"
+        f"sentiment: {SENTIMENT_PROMPT}"
+    )
+
+    def __init__(self):
+        # Chaves e cliente Gemini são inicializados sob demanda (ver propriedades abaixo)
         self.gemini_model_name = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
-        self.gemini_client = genai.GenerativeModel(self.gemini_model_name)
+        self.aio_session = None # Sessão aiohttp (ElevenLabs e Gemini) aberta apenas durante _aio_session_scope
+        self._aio_session_users = 0 # Quantos _aio_session_scope estão usando a sessão aberta
+        # Sem limite de tempo total (uploads longos + processamento do Scribe), mas com limite para conectar e para cada leitura
+        self.HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv('HTTP_CONNECT_TIMEOUT_SECONDS', 30))
+        self.HTTP_READ_TIMEOUT_SECONDS = float(os.getenv('HTTP_READ_TIMEOUT_SECONDS', 900))
+        self.GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', 8))
+        self._gemini_semaphore = None
+        # Cache de contexto do Gemini para os prompts de sistema: é cobrado e exige um mínimo de tokens, então fica desligado por padrão
+        self.GEMINI_CONTEXT_CACHE = os.getenv('GEMINI_CONTEXT_CACHE', 'false').lower() in ('1', 'true', 'yes')
+        # Identificadores persistidos em disco para serem reaproveitados entre execuções até expirarem
+        self.gemini_context_cache_path = os.path.join(tempfile.gettempdir(), "gemini-context-cache.json")
+        self._gemini_cached_contents = {} # hash do modelo + prompt -> (nome do cache no Gemini ou None, expiração em epoch)
+        self._gemini_context_cache_lock = None
         
         self.elevenlabs_scribe_model_id = os.getenv("ELEVENLABS_SCRIBE_MODEL_ID", "scribe_v1")
+        self._last_meeting_minutes = None
         
         self.MAX_AUDIO_SIZE_BYTES = int(os.getenv('MAX_AUDIO_SIZE_BYTES', 20 * 1024 * 1024)) # Mantido, mas a ElevenLabs tem seus próprios limites (1GB para arquivo, 2GB para URL)
 
-    def get_file_size(self, file_path):
-        return os.path.getsize(file_path)
+        # Cache local das transcrições, indexado pelo hash do áudio + modelo
+        self.stt_cache_dir = os.path.join(tempfile.gettempdir(), "stt-cache")
+        self.STT_CACHE_TTL_SECONDS = int(os.getenv('STT_CACHE_TTL_SECONDS', 7 * 24 * 3600)) # 0 = sem expiração
+
+        # Cache LRU das respostas do Gemini: hash exato do prompt + similaridade semântica da transcrição
+        self.gemini_embedding_model = os.getenv("GEMINI_EMBEDDING_MODEL", "models/text-embedding-004")
+        self.GEMINI_CACHE_SIZE = int(os.getenv('GEMINI_CACHE_SIZE', 32))
+        # O nível semântico reaproveita respostas de transcrições parecidas (ex.: reuniões recorrentes), então é opcional
+        self.GEMINI_SEMANTIC_CACHE = os.getenv('GEMINI_SEMANTIC_CACHE', 'false').lower() in ('1', 'true', 'yes')
+        self.GEMINI_SEMANTIC_CACHE_THRESHOLD = float(os.getenv('GEMINI_SEMANTIC_CACHE_THRESHOLD', 0.97))
+        # O modelo de embedding aceita cerca de 2k tokens; textos maiores ficam fora do nível semântico
+        self.GEMINI_EMBEDDING_MAX_CHARS = int(os.getenv('GEMINI_EMBEDDING_MAX_CHARS', 8000))
+        self._gemini_cache = collections.OrderedDict()
+
+        # Transcrições maiores que isso são resumidas em blocos (map-reduce) antes da análise
+        self.MAP_REDUCE_THRESHOLD_CHARS = int(os.getenv('MAP_REDUCE_THRESHOLD_CHARS', 30000))
+
+        # Diretório único para os JSONs das reuniões, em vez de um diretório temporário novo a cada chamada;
+        # assim como o mkdtemp() de antes, só o usuário atual tem acesso a ele
+        self.meeting_out_dir = os.getenv("MEETING_OUT_DIR", os.path.join(tempfile.gettempdir(), "meetings"))
+        _ensure_private_dir(self.meeting_out_dir)
+
+    @functools.cached_property
+    def elevenlabs_api_key(self):
+        elevenlabs_api_key = os.getenv("ELEVENLABS_API_KEY")
+        if not elevenlabs_api_key:
+            raise ValueError("ELEVENLABS_API_KEY não configurada nas variáveis de ambiente.")
+        return elevenlabs_api_key
+
+    @functools.cached_property
+    def gemini_api_key(self):
+        gemini_api_key = os.getenv("GEMINI_API_KEY")
+        if not gemini_api_key:
+            raise ValueError("GEMINI_API_KEY não configurada nas variáveis de ambiente.")
+        return gemini_api_key
+
+    @functools.cached_property
+    def gemini_client(self):
+        # SDK do Gemini configurado na primeira vez que é usado (embeddings)
+        genai.configure(api_key=self.gemini_api_key)
+        return genai
 
     def get_audio_duration(self, audio_file_path):
-        result = subprocess.run(['ffprobe', '-i', audio_file_path, '-show_entries', 'format=duration', '-v', 'quiet', '-of', 'csv=%s' % ("p=0")], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        # Lê a duração direto do cabeçalho do arquivo; o ffprobe fica só para formatos que o mutagen não reconhece
+        try:
+            audio = MutagenFile(audio_file_path)
+            if audio is not None and audio.info is not None:
+                return float(audio.info.length)
+        except MutagenError:
+            pass
+        result = subprocess.run(['ffprobe', '-i', audio_file_path, '-show_entries', 'format=duration', '-v', 'quiet', '-of', 'csv=p=0'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
         return float(result.stdout)
 
-    def resize_audio_if_needed(self, audio_file_path):
-        # Esta função pode precisar de ajustes ou ser removida dependendo dos limites e tratamento da ElevenLabs
-        # Por enquanto, vamos mantê-la, mas ciente que a ElevenLabs lida com arquivos grandes.
-        audio_size = self.get_file_size(audio_file_path)
-        if audio_size > self.MAX_AUDIO_SIZE_BYTES: # Comparando com um limite antigo, ElevenLabs suporta mais
-            print(f"Aviso: O áudio ({audio_size} bytes) excede MAX_AUDIO_SIZE_BYTES ({self.MAX_AUDIO_SIZE_BYTES} bytes) definido localmente, mas a ElevenLabs pode suportá-lo.")
-            # Não vamos redimensionar automaticamente por enquanto, pois a ElevenLabs tem limites maiores.
-            # Se o envio falhar devido ao tamanho, esta lógica pode ser reativada ou ajustada.
-            # current_duration = self.get_audio_duration(audio_file_path)
-            # target_duration = current_duration * self.MAX_AUDIO_SIZE_BYTES / audio_size
-            # temp_dir = tempfile.mkdtemp()
-            # print(f"Compressed audio will be stored in {temp_dir}")
-            # compressed_audio_path = os.path.join(temp_dir, f'compressed_audio_{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}.wav')
-            # subprocess.run(['ffmpeg', '-i', audio_file_path, '-ss', '0', '-t', str(target_duration), compressed_audio_path])
-            # return compressed_audio_path
-        return audio_file_path
+    async def _transcription_cache_key(self, audio_file):
+        # Hash calculado em blocos de 1 MiB para não carregar o áudio inteiro na memória
+        digest = hashlib.sha256()
+        while chunk := await audio_file.read(1024 * 1024):
+            digest.update(chunk)
+        await audio_file.seek(0)
+        return f"{digest.hexdigest()}:{self.elevenlabs_scribe_model_id}"
 
-    def transcribe_audio(self, audio_file_path):
-        url = "https://api.elevenlabs.io/v1/speech-to-text"
-        headers = {
-            "xi-api-key": self.elevenlabs_api_key
-        }
-        data = {
-            "model_id": self.elevenlabs_scribe_model_id
-            # Outros parâmetros como language_code, num_speakers podem ser adicionados aqui se necessário
-        }
-        
+    def _transcription_cache_path(self, cache_key):
+        # ':' não é válido em nomes de arquivo no Windows
+        return os.path.join(self.stt_cache_dir, cache_key.replace(":", "_") + ".json")
+
+    def _load_cached_transcription(self, cache_key):
+        try:
+            with open(self._transcription_cache_path(cache_key), 'r') as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if self.STT_CACHE_TTL_SECONDS and time.time() - entry.get("created_at", 0) > self.STT_CACHE_TTL_SECONDS:
+            return None
+        return entry.get(cache_key)
+
+    def _store_cached_transcription(self, cache_key, text):
+        # As transcrições ficam num diretório privado e cada entrada é gravada de forma atômica,
+        # como em store_in_json_file, para que uma leitura nunca encontre um JSON pela metade
+        file_path = self._transcription_cache_path(cache_key)
+        tmp_file_path = file_path + ".tmp"
+        try:
+            _ensure_private_dir(self.stt_cache_dir)
+            with open(tmp_file_path, 'w', opener=_private_file_opener) as f:
+                json.dump({cache_key: text, "created_at": time.time()}, f)
+            os.replace(tmp_file_path, file_path)
+        except OSError as e:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp_file_path)
+            logger.warning("Não foi possível gravar o cache da transcrição: %s", e)
+
+    async def _send_elevenlabs_form(self, form):
+        async with self.aio_session.post(self.ELEVENLABS_STT_URL, data=form, headers={"xi-api-key": self.elevenlabs_api_key}) as response:
+            if response.status >= 400:
+                # O corpo da resposta traz os detalhes do erro, então ele vai junto na exceção
+                raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status, message=await response.text())
+            return await response.json(content_type=None)
+
+    @upload_retry
+    async def _post_audio_to_elevenlabs(self, audio_file_path):
+        # O objeto de arquivo vai direto no formulário: o aiohttp lê os blocos fora do event loop e,
+        # como o tamanho é conhecido, envia Content-Length em vez de um corpo em chunked.
+        # Cada tentativa abre o arquivo de novo, já que o envio o consome
         with open(audio_file_path, 'rb') as audio_file:
-            files = {
-                'file': (os.path.basename(audio_file_path), audio_file, 'audio/mpeg') # Tentar inferir ou usar um tipo comum
-            }
+            form = aiohttp.FormData()
+            form.add_field("model_id", self.elevenlabs_scribe_model_id)
+            # Outros parâmetros como language_code, num_speakers podem ser adicionados aqui se necessário
+            form.add_field("file", audio_file, filename=os.path.basename(audio_file_path), content_type='audio/mpeg') # Tentar inferir ou usar um tipo comum
+            return await self._send_elevenlabs_form(form)
+
+    @upload_retry
+    async def _post_cloud_url_to_elevenlabs(self, cloud_storage_url):
+        # A ElevenLabs baixa o áudio direto da URL (limite de 2GB), então nada é enviado a partir do disco
+        form = aiohttp.FormData(default_to_multipart=True)
+        form.add_field("model_id", self.elevenlabs_scribe_model_id)
+        form.add_field("cloud_storage_url", cloud_storage_url)
+        return await self._send_elevenlabs_form(form)
+
+    async def _transcribe_local_audio(self, audio_file_path):
+        async with aiofiles.open(audio_file_path, 'rb') as audio_file:
+            audio_size = os.fstat(audio_file.fileno()).st_size
+            if audio_size > self.MAX_AUDIO_SIZE_BYTES: # Comparando com um limite antigo, ElevenLabs suporta mais
+                logger.warning("O áudio (%d bytes) excede MAX_AUDIO_SIZE_BYTES (%d bytes) definido localmente, mas a ElevenLabs pode suportá-lo.", audio_size, self.MAX_AUDIO_SIZE_BYTES)
+
+            cache_key = await self._transcription_cache_key(audio_file)
+            cached_text = self._load_cached_transcription(cache_key)
+            if cached_text is not None:
+                logger.info("Transcribe (cache): Done")
+                return cached_text
+
+        transcript_data = await self._post_audio_to_elevenlabs(audio_file_path)
+        logger.info("Transcribe (ElevenLabs): Done")
+        # A documentação indica que o texto completo está em transcript_data["text"]
+        text = transcript_data.get("text", "")
+        self._store_cached_transcription(cache_key, text)
+        return text
+
+    async def transcribe_audio_async(self, audio_file_path):
+        # Aceita um caminho local ou a URL http(s) de um áudio já hospedado (ex.: bucket na nuvem)
+        async with self._aio_session_scope():
             try:
-                response = requests.post(url, headers=headers, data=data, files=files)
-                response.raise_for_status()  # Levanta um erro para códigos de status HTTP ruins (4xx ou 5xx)
-                transcript_data = response.json()
-                print("Transcribe (ElevenLabs): Done")
-                # A documentação indica que o texto completo está em transcript_data["text"]
-                return transcript_data.get("text", "") 
-            except requests.exceptions.RequestException as e:
-                print(f"Erro na transcrição com ElevenLabs: {e}")
-                if hasattr(e, 'response') and e.response is not None:
-                    print(f"Detalhes do erro: {e.response.text}")
+                # Caminhos como pathlib.Path continuam aceitos; só strings podem ser URLs
+                if isinstance(audio_file_path, str) and audio_file_path.startswith(("http://", "https://")):
+                    # Sem arquivo local não há como calcular o hash, então o cache de transcrições não se aplica aqui
+                    transcript_data = await self._post_cloud_url_to_elevenlabs(audio_file_path)
+                    logger.info("Transcribe (ElevenLabs, URL): Done")
+                    return transcript_data.get("text", "")
+                return await self._transcribe_local_audio(audio_file_path)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error("Erro na transcrição com ElevenLabs: %s", e)
                 return None # Retornar None ou levantar uma exceção mais específica
-            except json.JSONDecodeError:
-                print(f"Erro ao decodificar JSON da resposta da ElevenLabs: {response.text}")
+            except json.JSONDecodeError as e:
+                logger.error("Erro ao decodificar JSON da resposta da ElevenLabs: %s", e)
                 return None
 
-    def _generate_gemini_content(self, system_prompt, user_transcription):
-        prompt_parts = [
-            types.Part.from_text(f"{system_prompt}\n\nTexto para analisar:\n{user_transcription}")
-        ]
-        contents = [types.Content(role="user", parts=prompt_parts)]
-        
+    def transcribe_audio(self, audio_file_path):
+        return asyncio.run(self.transcribe_audio_async(audio_file_path))
+
+    @contextlib.asynccontextmanager
+    async def _aio_session_scope(self):
+        # Uma única sessão aiohttp, compartilhada por ElevenLabs e Gemini, durante toda a execução.
+        # Chamadas aninhadas ou simultâneas (ex.: asyncio.gather) reaproveitam a sessão já aberta,
+        # que só é fechada quando a última delas termina
+        if self.aio_session is None:
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.HTTP_CONNECT_TIMEOUT_SECONDS, sock_read=self.HTTP_READ_TIMEOUT_SECONDS)
+            # Uma conexão por requisição simultânea ao Gemini, mais uma para o envio à ElevenLabs
+            connector = aiohttp.TCPConnector(limit=self.GEMINI_MAX_CONCURRENCY + 1)
+            self.aio_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            # O semáforo e o lock também são criados por execução, já que ficam presos ao event loop em que são usados
+            self._gemini_semaphore = asyncio.Semaphore(self.GEMINI_MAX_CONCURRENCY)
+            self._gemini_context_cache_lock = asyncio.Lock()
+        session = self.aio_session
+        self._aio_session_users += 1
         try:
-            response = self.gemini_client.generate_content(contents=contents)
-            return response.text
+            yield session
+        finally:
+            self._aio_session_users -= 1
+            if self._aio_session_users == 0:
+                self.aio_session = None
+                self._gemini_semaphore = None
+                self._gemini_context_cache_lock = None
+                await session.close()
+
+    def _load_context_cache_entries(self):
+        try:
+            with open(self.gemini_context_cache_path, 'r') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    def _store_context_cache_entry(self, cache_key, cached_name, expires_at):
+        entries = self._load_context_cache_entries()
+        if expires_at is None:
+            entries.pop(cache_key, None)
+        else:
+            entries[cache_key] = {"name": cached_name, "expires_at": expires_at}
+        try:
+            with open(self.gemini_context_cache_path, 'w') as f:
+                json.dump(entries, f)
+        except OSError as e:
+            logger.warning("Não foi possível gravar o cache de contexto do Gemini: %s", e)
+
+    def _create_cached_content(self, system_prompt):
+        # Chamada síncrona do SDK; roda em uma thread para não travar o event loop
+        cached_content = self.gemini_client.caching.CachedContent.create(
+            model=f"models/{self.gemini_model_name}",
+            system_instruction=system_prompt,
+            ttl=self.GEMINI_CONTEXT_CACHE_TTL
+        )
+        return cached_content.name
+
+    def _context_cache_key(self, system_prompt):
+        # A chave da API entra no hash: um cache criado com outra chave (ou projeto) não é acessível com a atual
+        api_key_hash = hashlib.sha256(self.gemini_api_key.encode()).hexdigest()
+        return hashlib.sha256(f"{api_key_hash}\x00{self.gemini_model_name}\x00{system_prompt}".encode()).hexdigest()
+
+    async def _drop_cached_content_name(self, system_prompt, cached_name):
+        # Esquece um cache rejeitado pelo Gemini (expirado, apagado ou de outra chave), para que seja criado de novo
+        cache_key = self._context_cache_key(system_prompt)
+        async with self._gemini_context_cache_lock:
+            # Outra chamada simultânea pode já ter trocado o cache por um novo; nesse caso ele é mantido
+            if self._gemini_cached_contents.get(cache_key, (None, 0))[0] == cached_name:
+                self._gemini_cached_contents.pop(cache_key)
+                self._store_context_cache_entry(cache_key, None, None)
+
+    async def _get_cached_content_name(self, system_prompt):
+        # Envia o prompt de sistema uma vez para o cache de contexto do Gemini e reaproveita o identificador,
+        # inclusive entre execuções, enquanto ele não expira
+        if not self.GEMINI_CONTEXT_CACHE:
+            return None
+
+        cache_key = self._context_cache_key(system_prompt)
+        # O lock evita que chamadas simultâneas (blocos do map-reduce) criem o mesmo cache várias vezes
+        async with self._gemini_context_cache_lock:
+            if cache_key not in self._gemini_cached_contents:
+                entry = self._load_context_cache_entries().get(cache_key, {})
+                self._gemini_cached_contents[cache_key] = (entry.get("name"), entry.get("expires_at", 0))
+            cached_name, expires_at = self._gemini_cached_contents[cache_key]
+            if time.time() < expires_at:
+                return cached_name
+
+            try:
+                cached_name = await asyncio.to_thread(self._create_cached_content, system_prompt)
+            except Exception as e:
+                # Prompts abaixo do mínimo de tokens do cache (ou modelos sem suporte) seguem com o prompt completo;
+                # a falha também fica registrada até o fim do TTL para não repetir a tentativa a cada execução
+                logger.warning("Cache de contexto do Gemini indisponível, enviando o prompt completo: %s", e)
+                cached_name = None
+            # Renova um pouco antes de expirar para não usar um cache que acabou de sumir
+            expires_at = time.time() + (self.GEMINI_CONTEXT_CACHE_TTL - datetime.timedelta(minutes=5)).total_seconds()
+            self._gemini_cached_contents[cache_key] = (cached_name, expires_at)
+            self._store_context_cache_entry(cache_key, cached_name, expires_at)
+            return cached_name
+
+    async def _stream_gemini(self, body):
+        # Chamada direta à API REST do Gemini com resposta em streaming (Server-Sent Events)
+        url = self.GEMINI_STREAM_URL.format(model=self.gemini_model_name)
+        text_parts = []
+        last_event = None
+        async with self._gemini_semaphore:
+            async with self.aio_session.post(url, params={"alt": "sse"}, headers={"x-goog-api-key": self.gemini_api_key}, json=body) as response:
+                response.raise_for_status()
+                async for line in response.content:
+                    if not line.startswith(b"data:"):
+                        continue
+                    last_event = json.loads(line[len(b"data:"):])
+                    candidates = last_event.get("candidates") or [{}]
+                    for part in candidates[0].get("content", {}).get("parts", []):
+                        text_parts.append(part.get("text", ""))
+
+        if not text_parts:
+            # Normalmente acontece quando o prompt é bloqueado; o feedback vem no último evento
+            raise ValueError(f"Resposta vazia do Gemini: {last_event}")
+        return "".join(text_parts)
+
+    @api_retry
+    async def _agen(self, system_prompt, user_part, json_output=False):
+        # O prompt de sistema vai separado da transcrição, então user_part é reaproveitado sem cópias.
+        body = {"contents": [{"role": "user", "parts": [user_part]}]}
+        if json_output:
+            body["generationConfig"] = {"responseMimeType": "application/json"}
+
+        cached_content_name = await self._get_cached_content_name(system_prompt)
+        if cached_content_name is not None:
+            # O prompt de sistema já está no cache do Gemini; só a transcrição é enviada
+            try:
+                return await self._stream_gemini({**body, "cachedContent": cached_content_name})
+            except aiohttp.ClientResponseError as e:
+                if e.status not in (400, 403, 404):
+                    raise
+                # Cache expirado, apagado ou criado com outra chave: descarta e tenta uma vez com o prompt completo
+                logger.warning("Cache de contexto do Gemini rejeitado (%d), enviando o prompt completo", e.status)
+                await self._drop_cached_content_name(system_prompt, cached_content_name)
+
+        return await self._stream_gemini({**body, "systemInstruction": {"parts": [{"text": system_prompt}]}})
+
+    def _embed_transcription(self, user_transcription):
+        try:
+            result = self.gemini_client.embed_content(model=self.gemini_embedding_model, content=user_transcription)
         except Exception as e:
-            print(f"Erro ao gerar conteúdo com Gemini: {e}")
-            # Você pode querer verificar response.prompt_feedback aqui também
-            # if hasattr(response, 'prompt_feedback') and response.prompt_feedback:
-            #     print(f"Prompt Feedback: {response.prompt_feedback}")
+            logger.warning("Não foi possível gerar o embedding da transcrição: %s", e)
+            return None
+        embedding = numpy.asarray(result["embedding"], dtype=numpy.float32)
+        norm = numpy.linalg.norm(embedding)
+        return embedding / norm if norm else None
+
+    def _has_semantic_candidates(self, scope):
+        return any(entry_scope == scope and entry_embedding is not None for entry_scope, entry_embedding, _ in self._gemini_cache.values())
+
+    def _find_similar_gemini_result(self, scope, embedding):
+        if embedding is None:
+            return None
+        best_key, best_score = None, self.GEMINI_SEMANTIC_CACHE_THRESHOLD
+        for key, (entry_scope, entry_embedding, _) in self._gemini_cache.items():
+            if entry_scope != scope or entry_embedding is None:
+                continue
+            # Os embeddings já estão normalizados, então o produto escalar é o cosseno
+            score = float(numpy.dot(embedding, entry_embedding))
+            if score >= best_score:
+                best_key, best_score = key, score
+        if best_key is None:
+            return None
+        self._gemini_cache.move_to_end(best_key)
+        return self._gemini_cache[best_key][2]
+
+    def _build_user_part(self, transcription):
+        # Monta uma única vez a parte do conteúdo com a transcrição, reutilizada por cache, embedding e requisição
+        return {"text": f"Texto para analisar:\n{transcription}"}
+
+    async def _generate_gemini_content(self, system_prompt, user_part, json_output=False):
+        scope = (system_prompt, json_output)
+        digest = hashlib.blake2b(system_prompt.encode())
+        digest.update(b"\x00json\x00" if json_output else b"\x00text\x00")
+        digest.update(user_part["text"].encode())
+        cache_key = digest.hexdigest()
+        if cache_key in self._gemini_cache:
+            self._gemini_cache.move_to_end(cache_key)
+            logger.info("Gemini (cache): Done")
+            return self._gemini_cache[cache_key][2]
+
+        use_embedding = self.GEMINI_SEMANTIC_CACHE and len(user_part["text"]) <= self.GEMINI_EMBEDDING_MAX_CHARS
+        embedding = None
+        if use_embedding and self._has_semantic_candidates(scope):
+            embedding = await asyncio.to_thread(self._embed_transcription, user_part["text"])
+            cached_text = self._find_similar_gemini_result(scope, embedding)
+            if cached_text is not None:
+                logger.info("Gemini (semantic cache): Done")
+                return cached_text
+
+        try:
+            if use_embedding and embedding is None:
+                # Sem respostas para comparar ainda: o embedding só é guardado, e é gerado em paralelo com a resposta
+                text, embedding = await asyncio.gather(
+                    self._agen(system_prompt, user_part, json_output),
+                    asyncio.to_thread(self._embed_transcription, user_part["text"])
+                )
+            else:
+                text = await self._agen(system_prompt, user_part, json_output)
+        except Exception as e:
+            logger.error("Erro ao gerar conteúdo com Gemini: %s", e)
             return f"Erro ao gerar conteúdo: {e}"
 
+        if json_output:
+            # Respostas que não são JSON válido não entram no cache, para que a próxima chamada tente de novo
+            try:
+                json.loads(text)
+            except json.JSONDecodeError:
+                return text
+
+        self._gemini_cache[cache_key] = (scope, embedding, text)
+        while len(self._gemini_cache) > self.GEMINI_CACHE_SIZE:
+            self._gemini_cache.popitem(last=False)
+        return text
+
+    def _split_into_chunks(self, sentences, max_chars):
+        chunks, current, current_size = [], [], 0
+        for sentence in sentences:
+            if current and current_size + len(sentence) > max_chars:
+                chunks.append(" ".join(current))
+                current, current_size = [], 0
+            current.append(sentence)
+            current_size += len(sentence) + 1
+        if current:
+            chunks.append(" ".join(current))
+        return chunks
+
+    async def _summarize_chunks(self, chunks):
+        summaries = await asyncio.gather(
+            *(self._agen(self.CHUNK_SUMMARY_PROMPT, self._build_user_part(chunk)) for chunk in chunks),
+            return_exceptions=True
+        )
+        # Se o resumo de um bloco falhar, o texto original do bloco é usado no lugar
+        return [chunk if isinstance(summary, Exception) else summary for chunk, summary in zip(chunks, summaries)]
+
+    async def _preprocess_transcription(self, transcription):
+        # Reduz a quantidade de tokens enviada ao Gemini sem perder conteúdo relevante
+        sentences = []
+        for original in SENTENCE_SPLIT_RE.split(transcription):
+            sentence = " ".join(FILLER_WORDS_RE.sub("", original).split()).lstrip(",;: ")
+            # Frases que eram só hesitação (ex.: "Hmm.") sobram apenas com pontuação e são descartadas
+            if not any(char.isalnum() for char in sentence):
+                continue
+            # Quando a hesitação abria a frase, a maiúscula inicial é mantida ("Eh, o prazo..." -> "O prazo...")
+            if original.lstrip()[:1].isupper():
+                sentence = sentence[0].upper() + sentence[1:]
+            if not sentences or sentence.lower() != sentences[-1].lower():
+                sentences.append(sentence)
+        text = " ".join(sentences)
+
+        if len(text) > self.MAP_REDUCE_THRESHOLD_CHARS:
+            chunks = self._split_into_chunks(sentences, self.MAP_REDUCE_THRESHOLD_CHARS)
+            try:
+                text = "\n\n".join(await self._summarize_chunks(chunks))
+                logger.info("Transcription pre-summary (Gemini, %d chunks): Done", len(chunks))
+            except Exception as e:
+                logger.error("Erro ao resumir a transcrição em blocos com Gemini: %s", e)
+        return text
+
+    async def _generate_meeting_minutes_json(self, transcription):
+        # Uma única chamada ao Gemini gera as quatro seções; o resultado fica guardado
+        # para que os extratores individuais não repitam a requisição
+        if transcription is None:
+            # transcribe_audio devolve None quando a transcrição falha
+            logger.error("Transcrição indisponível, análise da reunião ignorada")
+            return {key: "" for key in self.MEETING_MINUTES_KEYS}
+
+        if self._last_meeting_minutes is not None and self._last_meeting_minutes[0] == transcription:
+            return self._last_meeting_minutes[1]
+
+        analysis_text = await self._preprocess_transcription(transcription)
+        user_part = self._build_user_part(analysis_text)
+        response_text = await self._generate_gemini_content(self.MEETING_MINUTES_PROMPT, user_part, json_output=True)
+        try:
+            parsed = json.loads(response_text)
+            minutes = {key: parsed.get(key, "") for key in self.MEETING_MINUTES_KEYS}
+        except (json.JSONDecodeError, AttributeError):
+            logger.error("Erro ao decodificar JSON da resposta do Gemini")
+            logger.debug("Resposta do Gemini: %s", response_text)
+            return {key: response_text for key in self.MEETING_MINUTES_KEYS}
+
+        logger.info("Meeting Minutes (Gemini): Done")
+        self._last_meeting_minutes = (transcription, minutes)
+        return minutes
+
 
     def abstract_summary_extraction(self, transcription):
-        system_prompt = "Você é uma IA altamente qualificada, treinada em compreensão de linguagem e sumarização. Gostaria que você lesse o texto a seguir e o resumisse em um parágrafo abstrato conciso. Procure reter os pontos mais importantes, fornecendo um resumo coerente e legível que possa ajudar uma pessoa a entender os pontos principais da discussão sem precisar ler o texto inteiro. Evite detalhes desnecessários ou pontos tangenciais."
-        summary = self._generate_gemini_content(system_prompt, transcription)
-        print("Summary (Gemini): Done")
-        return summary
+        return self.meeting_minutes(transcription)['abstract_summary']
 
     def key_points_extraction(self, transcription):
-        system_prompt = "Você é uma IA proficiente com especialidade em destilar informações em pontos-chave. Com base no texto a seguir, identifique e liste os principais pontos que foram discutidos ou levantados. Devem ser as ideias, descobertas ou tópicos mais importantes que são cruciais para a essência da discussão. Seu objetivo é fornecer uma lista que alguém possa ler para entender rapidamente sobre o que foi falado."
-        key_points = self._generate_gemini_content(system_prompt, transcription)
-        print("Key Points (Gemini): Done")
-        return key_points
+        return self.meeting_minutes(transcription)['key_points']
 
     def action_item_extraction(self, transcription):
-        system_prompt = "Você é um especialista em IA em analisar conversas e extrair itens de ação. Revise o texto e identifique quaisquer tarefas, atribuições ou ações que foram acordadas ou mencionadas como necessitando ser feitas. Podem ser tarefas atribuídas a indivíduos específicos ou ações gerais que o grupo decidiu tomar. Liste esses itens de ação de forma clara e concisa."
-        action_items = self._generate_gemini_content(system_prompt, transcription)
-        print("Action Items (Gemini): Done")
-        return action_items
+        return self.meeting_minutes(transcription)['action_items']
 
     def sentiment_analysis(self, transcription):
-        system_prompt = "Como uma IA com experiência em análise de linguagem e emoção, sua tarefa é analisar o sentimento do texto a seguir. Considere o tom geral da discussão, a emoção transmitida pela linguagem utilizada e o contexto em que palavras e frases são usadas. Indique se o sentimento é geralmente positivo, negativo ou neutro e forneça breves explicações para sua análise, quando possível."
-        sentiment = self._generate_gemini_content(system_prompt, transcription)
-        print("Sentiment (Gemini): Done")
-        return sentiment
+        return self.meeting_minutes(transcription)['sentiment']
+
+    async def meeting_minutes_async(self, transcription):
+        async with self._aio_session_scope():
+            return await self._generate_meeting_minutes_json(transcription)
 
     def meeting_minutes(self, transcription):
-        abstract_summary = self.abstract_summary_extraction(transcription)
-        key_points = self.key_points_extraction(transcription)
-        action_items = self.action_item_extraction(transcription)
-        sentiment = self.sentiment_analysis(transcription)
-        return {
-            'abstract_summary': abstract_summary,
-            'key_points': key_points,
-            'action_items': action_items,
-            'sentiment': sentiment
-        }
+        return asyncio.run(self.meeting_minutes_async(transcription))
 
     def store_in_json_file(self, data):
-        temp_dir = tempfile.mkdtemp()
-        file_path = os.path.join(temp_dir, f'meeting_data_{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}.json')
+        # Microssegundos no nome evitam que duas reuniões no mesmo segundo sobrescrevam o mesmo arquivo
+        file_path = os.path.join(self.meeting_out_dir, f'meeting_data_{datetime.datetime.now().strftime("%Y%m%d%H%M%S_%f")}.json')
         print(f"JSON file path: {file_path}")
-        with open(file_path, 'w') as f:
-            json.dump(data, f)
-        print("JSON file created successfully.")
+        # Grava num arquivo temporário e renomeia, para nunca deixar um JSON pela metade
+        tmp_file_path = file_path + ".tmp"
+        try:
+            with open(tmp_file_path, 'wb', opener=_private_file_opener) as f:
+                f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+            os.replace(tmp_file_path, file_path)
+        except BaseException:
+            # Não deixa o .tmp para trás se a serialização ou a gravação falhar
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp_file_path)
+            raise
+        logger.info("JSON file created successfully.")
 
-    def transcribe(self, audio_file_path):
-        audio_file_path = self.resize_audio_if_needed(audio_file_path)
-        transcription = self.transcribe_audio(audio_file_path)
-        summary = self.meeting_minutes(transcription)
+    async def transcribe_async(self, audio_file_path):
+        # Upload, pré-resumo e ata rodam no mesmo event loop e na mesma sessão aiohttp (keep-alive entre as etapas)
+        async with self._aio_session_scope():
+            # O cache de contexto do prompt da ata (se habilitado) é preparado enquanto o áudio é transcrito
+            transcription, _ = await asyncio.gather(
+                self.transcribe_audio_async(audio_file_path),
+                self._get_cached_content_name(self.MEETING_MINUTES_PROMPT)
+            )
+            if transcription is None:
+                logger.error("Falha na transcrição de %s, análise da reunião ignorada", audio_file_path)
+                return
+            summary = await self._generate_meeting_minutes_json(transcription)
         self.store_in_json_file(summary)
     
+        # A ata é a saída do programa, não um log: vai sempre para o stdout, mesmo sem logging configurado
         print(f"Abstract Summary: {summary['abstract_summary']}")
         print(f"Key Points: {summary['key_points']}")
         print(f"Action Items: {summary['action_items']}")
         print(f"Sentiment: {summary['sentiment']}")
 
+    def transcribe(self, audio_file_path):
+        asyncio.run(self.transcribe_async(audio_file_path))